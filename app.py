@@ -1,37 +1,83 @@
 from quart import (
     Quart,
     request,
-    render_template_string,
     redirect,
     url_for,
     Response,
+    send_file,
 )
 import aiofiles
 import aiohttp
 from bs4 import BeautifulSoup
 import os
+import re
 import hashlib
 import mimetypes
 import urllib.parse
 from urllib.parse import urlparse, urljoin
 import time
+import asyncio
+import functools
 import pathlib
+from collections import OrderedDict
+from email.utils import formatdate
 
 # written with help of Claude.ai
 
+# uvloop is a faster drop-in replacement for the asyncio event loop, it is not available on Windows
+try:
+    import uvloop
+
+    uvloop.install()
+except ImportError:
+    pass
+
 app = Quart(__name__)
 
 # Create cache directory if it doesn't exist
-CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+# Versioned, since older layouts stored CSS and JS as .html files without a content type
+CACHE_VERSION = "v2"
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", CACHE_VERSION)
 os.makedirs(CACHE_DIR, exist_ok=True)
 
 PREFIX = '/cachingproxy'
-ALLOW_URLS = ["http://example.com", "https://adventofcode.com"]
+ALLOW_URLS = ("http://example.com", "https://adventofcode.com")
 ONE_MINUTE_IN_SECONDS = 60
 ONE_HOUR_IN_SECONDS = 60 * ONE_MINUTE_IN_SECONDS
 ONE_DAY_IN_SECONDS = 24 * ONE_HOUR_IN_SECONDS
 ONE_YEAR_IN_SECONDS = 365 * ONE_DAY_IN_SECONDS
 DEFAULT_CACHE_EXPIRY = ONE_YEAR_IN_SECONDS
+MEM_CACHE_MAX_ENTRIES = 256
+MEM_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Leave room for the extension and temporary file suffix within the usual 255 byte limit
+MAX_CACHE_KEY_LENGTH = 200
+STREAM_CHUNK_SIZE = 64 * 1024
+UPSTREAM_TIMEOUT_SECONDS = 10
+# Streamed bodies are read at the pace of the client, so only limit connecting and each read.
+# Buffered HTML bodies get a total limit of their own in the handler.
+UPSTREAM_TIMEOUT = aiohttp.ClientTimeout(
+    total=None, sock_connect=UPSTREAM_TIMEOUT_SECONDS, sock_read=UPSTREAM_TIMEOUT_SECONDS
+)
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+
+@app.before_serving
+async def create_http_session():
+    """Create one shared client session so upstream connections are reused"""
+    app.http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=75
+        ),
+        timeout=UPSTREAM_TIMEOUT,
+        headers={"User-Agent": USER_AGENT},
+    )
+
+
+@app.after_serving
+async def close_http_session():
+    """Close the shared client session on shutdown"""
+    await app.http_session.close()
+
 
 def readable(num_seconds: int) -> str:
     if num_seconds == ONE_DAY_IN_SECONDS:
@@ -40,41 +86,113 @@ def readable(num_seconds: int) -> str:
         return "one year"
     return f"{num_seconds} seconds"
 
+URL_ENCODE_TABLE = str.maketrans({"/": "$", ":": "#"})
+
+
 def encode_url(url):
     """https://stackoverflow.com/questions/66926813/use-url-as-filename"""
-    return url.replace("/", "$").replace(":", "#")
+    return url.translate(URL_ENCODE_TABLE)
 
 
+def cache_key(url):
+    """Filename (without extension) to cache a URL under"""
+    key = encode_url(url)
+    if len(key.encode()) > MAX_CACHE_KEY_LENGTH:
+        # Too long for the filesystem, use a hash instead
+        key = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+    return key
+
+
+# Netloc directories that are known to exist in the cache dir
+CREATED_DIRS = set()
+
+
+def ensure_netloc_dir(netloc):
+    """Create the cache directory for a netloc, at most once per process"""
+    if netloc not in CREATED_DIRS:
+        pathlib.Path(os.path.join(CACHE_DIR, netloc)).mkdir(exist_ok=True)
+        CREATED_DIRS.add(netloc)
+
+
+# Create the directories for the allowed urls up front
+for allowed_url in ALLOW_URLS:
+    ensure_netloc_dir(urlparse(allowed_url).netloc)
+
+
+@functools.lru_cache(maxsize=1024)
 def get_cache_path(url, content_type=None):
     """Generate a cache file path based on URL"""
-    url_hash = hashlib.md5(url.encode()).hexdigest()
     parsed = urlparse(url)
-    url_hash = encode_url(url)
+    url_hash = cache_key(url)
 
     ext = ".html"
-    if content_type and "image" in content_type:
-        # Extract extension from content type or URL
+    if content_type is not None and not content_type.startswith("text/html"):
+        # Extract extension from content type or URL, only HTML may use .html
         ext = (
-            mimetypes.guess_extension(content_type) or os.path.splitext(parsed.path)[1]
+            mimetypes.guess_extension(content_type.split(";")[0].strip())
+            or os.path.splitext(parsed.path)[1]
         )
-        if not ext:
+        if not ext or ext == ".html":
             ext = ".bin"  # Default extension if we can't determine it
-    fpath = os.path.join(CACHE_DIR, parsed.netloc, f"{url_hash}{ext}")
-    pathlib.Path(os.path.join(CACHE_DIR, parsed.netloc)).mkdir(exist_ok=True)
-    return fpath
+    return os.path.join(CACHE_DIR, parsed.netloc, f"{url_hash}{ext}")
+
+
+def get_content_type_path(url):
+    """Path of the file that stores the Content-Type of a cached non-HTML URL"""
+    parsed = urlparse(url)
+    return os.path.join(CACHE_DIR, parsed.netloc, f"{cache_key(url)}.ct")
 
 
-def is_cached(url, max_age=DEFAULT_CACHE_EXPIRY):
-    """Check if URL is cached and not expired. Max age in seconds."""
+def cache_stat(cache_path, max_age=DEFAULT_CACHE_EXPIRY):
+    """Return the os.stat result if the cache file exists and is not expired, else None. Max age in seconds."""
     # TODO could also use Last-Modified header
-    cache_path = get_cache_path(url)
-    if os.path.exists(cache_path):
-        # Check if cache is fresher than max_age
-        if time.time() - os.path.getmtime(cache_path) < max_age:
-            print("YES cached:", url)
-            return True
-    print("NOT cached:", url)
-    return False
+    try:
+        st = os.stat(cache_path)
+    except FileNotFoundError:
+        st = None
+    # Check if cache is fresher than max_age
+    if st and time.time() - st.st_mtime < max_age:
+        print("YES cached:", cache_path)
+        return st
+    print("NOT cached:", cache_path)
+    return None
+
+
+# In-memory LRU in front of the disk cache: url -> (content, content_type, stat result)
+MEM_CACHE = OrderedDict()
+mem_cache_bytes = 0
+
+
+def mem_cache_get(url, max_age=DEFAULT_CACHE_EXPIRY):
+    """Return (content, content_type, stat result) from the memory cache, or None"""
+    entry = MEM_CACHE.get(url)
+    if entry is None:
+        return None
+    if time.time() - entry[2].st_mtime >= max_age:
+        mem_cache_evict(url)
+        return None
+    MEM_CACHE.move_to_end(url)
+    return entry
+
+
+def mem_cache_evict(url):
+    """Remove a URL from the memory cache"""
+    global mem_cache_bytes
+    content, _, _ = MEM_CACHE.pop(url)
+    mem_cache_bytes -= len(content)
+
+
+def mem_cache_put(url, content, content_type, st):
+    """Store content in the memory cache, evicting least recently used entries"""
+    global mem_cache_bytes
+    if len(content) > MEM_CACHE_MAX_BYTES:
+        return
+    if url in MEM_CACHE:
+        mem_cache_evict(url)
+    MEM_CACHE[url] = (content, content_type, st)
+    mem_cache_bytes += len(content)
+    while len(MEM_CACHE) > MEM_CACHE_MAX_ENTRIES or mem_cache_bytes > MEM_CACHE_MAX_BYTES:
+        mem_cache_evict(next(iter(MEM_CACHE)))
 
 
 async def read_cache(cache_path, binary=False):
@@ -89,6 +207,14 @@ async def read_cache(cache_path, binary=False):
             return await f.read()
 
 
+async def read_content_type(url):
+    """Read the cached Content-Type of a non-HTML URL, None if none was stored"""
+    try:
+        return (await read_cache(get_content_type_path(url))).strip()
+    except FileNotFoundError:
+        return None
+
+
 async def write_cache(cache_path, content, binary=False):
     """Write content to cache asynchronously"""
     if binary:
@@ -99,6 +225,31 @@ async def write_cache(cache_path, content, binary=False):
             await f.write(content)
 
 
+async def stream_to_cache(url, response, content_type):
+    """Yield the upstream response body in chunks while writing it to the cache"""
+    cache_path = get_cache_path(url, content_type)
+    ensure_netloc_dir(urlparse(url).netloc)
+    # Write to a temporary file first, so a partial download never ends up in the cache
+    tmp_path = f"{cache_path}.{id(response)}.tmp"
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await f.write(chunk)
+                yield chunk
+        await write_cache(get_content_type_path(url), content_type)
+        os.replace(tmp_path, cache_path)
+    finally:
+        response.release()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@functools.lru_cache(maxsize=4096)
+def proxy_url(url):
+    """Proxy URL for an absolute URL, shared across pages since most of them link the same resources"""
+    return f"{PREFIX}/proxy?url={urllib.parse.quote(url)}"
+
+
 def rewrite_url(url, base_url):
     """Rewrite a URL to go through the proxy"""
     if not url:
@@ -111,65 +262,81 @@ def rewrite_url(url, base_url):
     # Handle relative URLs
     if not url.startswith(("http://", "https://")):
         # Convert to absolute URL based on base_url
-        return f"{PREFIX}/proxy?url={urllib.parse.quote(urljoin(base_url, url))}"
+        url = urljoin(base_url, url)
 
-    # Absolute URLs
-    return f"{PREFIX}/proxy?url={urllib.parse.quote(url)}"
+    return proxy_url(url)
+
+
+# A srcset candidate: the URL, optionally followed by a descriptor like 2x or 480w
+SRCSET_RE = re.compile(r"([^\s,]+)(\s+[^,]*)?")
+
+
+def rewrite_srcset(srcset, rewrite):
+    """Rewrite all candidate URLs in an img srcset attribute using the given rewrite function"""
+    return ", ".join(
+        rewrite(m.group(1)) + (m.group(2) or "").rstrip()
+        for m in SRCSET_RE.finditer(srcset)
+    )
 
 
 def rewrite_html(html_content, base_url):
-    """Rewrite HTML content to make all links go through the proxy"""
+    """Rewrite HTML content to make all links go through the proxy. Returns utf-8 encoded bytes."""
     if not html_content:
-        return ""
-
-    soup = BeautifulSoup(html_content, "html.parser")
-
-    # Rewrite links (a href)
-    for a in soup.find_all("a", href=True):
-        a["href"] = rewrite_url(a["href"], base_url)
-
-    # Rewrite image sources
-    for img in soup.find_all("img", src=True):
-        img["src"] = rewrite_url(img["src"], base_url)
-        # Also handle srcset if present
-        if img.get("srcset"):
-            srcsets = []
-            for srcset in img["srcset"].split(","):
-                parts = srcset.strip().split(" ")
-                if len(parts) >= 1:
-                    parts[0] = rewrite_url(parts[0], base_url)
-                srcsets.append(" ".join(parts))
-            img["srcset"] = ", ".join(srcsets)
-
-    # Rewrite CSS links
-    for link in soup.find_all("link", href=True):
-        if link.get("rel") and "stylesheet" in link.get("rel"):
-            link["href"] = rewrite_url(link["href"], base_url)
-
-    # Rewrite script sources
-    for script in soup.find_all("script", src=True):
-        script["src"] = rewrite_url(script["src"], base_url)
-
-    # Rewrite form actions
-    for form in soup.find_all("form", action=True):
-        form["action"] = rewrite_url(form["action"], base_url)
+        return b""
+
+    soup = BeautifulSoup(html_content, "lxml")
+
+    # Pages repeat the same URLs a lot, so memoize the rewrites for this page
+    rewrite = functools.lru_cache(maxsize=512)(
+        functools.partial(rewrite_url, base_url=base_url)
+    )
+    base_tag = stylesheet = stylesheet2 = None
+
+    # Rewrite links, image/script sources, stylesheets and form actions in a single pass
+    for tag in soup.descendants:
+        name = tag.name
+        if name is None:
+            continue
+        if name == "a":
+            if tag.get("href"):
+                tag["href"] = rewrite(tag["href"])
+        elif name == "img":
+            if tag.get("src"):
+                tag["src"] = rewrite(tag["src"])
+            # Also handle srcset if present
+            if tag.get("srcset"):
+                tag["srcset"] = rewrite_srcset(tag["srcset"], rewrite)
+        elif name == "link":
+            rel = tag.get("rel")
+            if rel and "stylesheet" in rel:
+                if tag.get("href"):
+                    tag["href"] = rewrite(tag["href"])
+                if stylesheet is None:
+                    stylesheet = tag
+                if stylesheet2 is None and " ".join(rel) == "stylesheet alternate":
+                    stylesheet2 = tag
+        elif name == "script":
+            if tag.get("src"):
+                tag["src"] = rewrite(tag["src"])
+        elif name == "form":
+            if tag.get("action"):
+                tag["action"] = rewrite(tag["action"])
+        elif name == "base":
+            if base_tag is None:
+                base_tag = tag
 
     # Add base target to keep everything in the proxy
-    base_tag = soup.find("base") or soup.new_tag("base")
+    has_base = base_tag is not None
+    if not has_base:
+        base_tag = soup.new_tag("base")
     base_tag["target"] = "_self"
     meta_tag = soup.new_tag("meta")
     meta_tag["name"] = "viewport"
     meta_tag["content"] = "width=device-width, initial-scale=1.0"
-    stylesheet2 = soup.find("link", attrs={
-        "rel": "stylesheet alternate",
-    })
     if stylesheet2:
-        stylesheet = soup.find("link", attrs={
-            "rel": "stylesheet",
-        })
         stylesheet["rel"] = "ONZIN"  # Make invalid
         stylesheet2["rel"] = "stylesheet"  # Make default
-    if not soup.find("base"):
+    if not has_base:
         if soup.head:
             soup.head.insert(0, base_tag)
             soup.head.append(meta_tag)
@@ -178,13 +345,40 @@ def rewrite_html(html_content, base_url):
             head.append(base_tag)
             soup.html.insert(0, head)
 
-    return str(soup)
+    # Encode once here, the bytes go to the cache and the client as is
+    return soup.encode(formatter="minimal")
 
 
-@app.route(f"{PREFIX}/")
-async def index():
-    """Display the form to enter a URL"""
-    template = f"""
+def cache_headers(st):
+    """Browser caching headers for a cached file, based on its stat result"""
+    return {
+        "Cache-Control": f"public, max-age={ONE_DAY_IN_SECONDS}",
+        "ETag": f'"{st.st_size:x}-{int(st.st_mtime):x}"',
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+    }
+
+
+def not_modified_response(st):
+    """Return a 304 response if the browser already has this version, else None"""
+    headers = cache_headers(st)
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return Response("", status=304, headers=headers)
+    return None
+
+
+def cached_response(content, content_type, st):
+    """Build the response for cached content, including browser caching headers"""
+    not_modified = not_modified_response(st)
+    if not_modified:
+        return not_modified
+    if "text/html" in content_type:
+        # HTML is always stored as utf-8
+        content_type = "text/html; charset=utf-8"
+    return Response(content, content_type=content_type, headers=cache_headers(st))
+
+
+# The index page only depends on constants, so render it once at import
+INDEX_HTML = f"""
     <!DOCTYPE html>
     <html>
     <head>
@@ -245,8 +439,60 @@ async def index():
         </form>
     </body>
     </html>
+    """.encode("utf-8")
+
+
+@app.route(f"{PREFIX}/")
+async def index():
+    """Display the form to enter a URL"""
+    return Response(INDEX_HTML, content_type="text/html; charset=utf-8")
+
+
+# Compile the error pages once instead of on every error
+STATUS_ERROR_TEMPLATE = app.jinja_env.from_string(
     """
-    return await render_template_string(template)
+    <html>
+    <head>
+        <title>Error</title>
+        <style>
+            body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
+            .error { background: #ffeeee; padding: 20px; border-radius: 5px; }
+            a { color: #0066cc; }
+        </style>
+    </head>
+    <body>
+        <h1>Error Fetching URL</h1>
+        <div class="error">
+            <p>There was an error fetching the requested URL: {{ url }}</p>
+            <p>Status Code: {{ status_code }}</p>
+        </div>
+        <p><a href="/">Back to home</a></p>
+    </body>
+    </html>
+    """
+)
+ERROR_TEMPLATE = app.jinja_env.from_string(
+    """
+    <html>
+    <head>
+        <title>Error</title>
+        <style>
+            body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
+            .error { background: #ffeeee; padding: 20px; border-radius: 5px; }
+            a { color: #0066cc; }
+        </style>
+    </head>
+    <body>
+        <h1>Error Fetching URL</h1>
+        <div class="error">
+            <p>There was an error fetching the requested URL: {{ url }}</p>
+            <p>Error: {{ error }}</p>
+        </div>
+        <p><a href="/">Back to home</a></p>
+    </body>
+    </html>
+    """
+)
 
 
 @app.route(f"{PREFIX}/proxy")
@@ -262,116 +508,86 @@ async def proxy_full_async():
         if not url.startswith(("http://", "https://")):
             url = "https://" + url
 
-        allowed = True
         # print(f"{url=}")
-        for allowed_url in ALLOW_URLS:
-            allowed = False
-            if url.startswith(allowed_url):
-                allowed = True
-                break
-
-        if not allowed:
+        if not url.startswith(ALLOW_URLS):
             raise Exception("Forbidden URL!")
-        # Check if content is cached
-        is_cached_content = is_cached(url)
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-
-        if is_cached_content:
-            # Use appropriate cache path
-            cache_path = get_cache_path(url)
-            if os.path.exists(cache_path):
-                if cache_path.endswith('.html'):
-                    # If it's HTML, we need to read and process it
-                    content = await read_cache(cache_path)
-                    return content
-                else:
-                    # If it's an image or other binary content
-                    content = await read_cache(cache_path, binary=True)
-                    return Response(content, content_type='image')
+        # Check the memory cache first, this avoids touching the disk
+        mem_cached = mem_cache_get(url)
+        if mem_cached:
+            return cached_response(*mem_cached)
+
+        # Check if content is cached on disk, HTML is the most common so try that first
+        cache_path = get_cache_path(url)
+        st = cache_stat(cache_path)
+        if st:
+            # Skip reading the file if the browser already has it
+            not_modified = not_modified_response(st)
+            if not_modified:
+                return not_modified
+            content = await read_cache(cache_path, binary=True)
+            mem_cache_put(url, content, "text/html", st)
+            return cached_response(content, "text/html", st)
+
+        # Other content types are stored next to the file, which has an extension based on it
+        content_type = await read_content_type(url)
+        st = None
+        if content_type is not None:
+            cache_path = get_cache_path(url, content_type)
+            st = cache_stat(cache_path)
+        if st:
+            not_modified = not_modified_response(st)
+            if not_modified:
+                return not_modified
+            # If it's an image or other binary content, let the server send the file directly
+            response = await send_file(
+                cache_path, mimetype=content_type.split(";")[0].strip(), conditional=True
+            )
+            # Send the stored content type as is, werkzeug would add a second charset to text/* types
+            response.headers["Content-Type"] = content_type
+            response.headers.update(cache_headers(st))
+            return response
 
 
         # Not cached or cache expired, fetch the content
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
-                # Check for successful response
-                if response.status != 200:
-                    return await render_template_string(
-                        """
-                    <html>
-                    <head>
-                        <title>Error</title>
-                        <style>
-                            body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
-                            .error { background: #ffeeee; padding: 20px; border-radius: 5px; }
-                            a { color: #0066cc; }
-                        </style>
-                    </head>
-                    <body>
-                        <h1>Error Fetching URL</h1>
-                        <div class="error">
-                            <p>There was an error fetching the requested URL: {{ url }}</p>
-                            <p>Status Code: {{ status_code }}</p>
-                        </div>
-                        <p><a href="/">Back to home</a></p>
-                    </body>
-                    </html>
-                    """,
-                        url=url,
-                        status_code=response.status,
-                    )
-
-                content_type = response.headers.get("content-type", "").lower()
-                cache_path = get_cache_path(url, content_type)
-
-                # Handle binary content (images, etc.)
-                if "text/html" not in content_type:
-                    # Get binary content
-                    content = await response.read()
-
-                    # Save to cache
-                    await write_cache(cache_path, content, binary=True)
-
-                    # Return the response
-                    return Response(content, content_type=content_type)
-
-                # Handle HTML content
-                html_content = await response.text()
-                processed_html = rewrite_html(html_content, url)
-
-                # Save to cache
-                await write_cache(cache_path, processed_html)
-
-                return processed_html
+        response = await app.http_session.get(url)
+        content_type = response.headers.get("content-type", "").lower()
+
+        # Handle binary content (images, etc.)
+        if response.status == 200 and not content_type.startswith("text/html"):
+            # Stream it to the client while saving it to the cache
+            return Response(
+                stream_to_cache(url, response, content_type),
+                content_type=content_type,
+            )
+
+        async with response:
+            # Check for successful response
+            if response.status != 200:
+                return await STATUS_ERROR_TEMPLATE.render_async(
+                    url=url, status_code=response.status
+                )
+
+            cache_path = get_cache_path(url, content_type)
+
+            # Handle HTML content
+            html_content = await asyncio.wait_for(
+                response.text(), timeout=UPSTREAM_TIMEOUT_SECONDS
+            )
+            # Rewriting is CPU bound, run it in a thread so other requests are not blocked
+            processed_html = await asyncio.get_running_loop().run_in_executor(
+                None, rewrite_html, html_content, url
+            )
+
+            # Save to cache
+            ensure_netloc_dir(urlparse(url).netloc)
+            await write_cache(cache_path, processed_html, binary=True)
+            st = os.stat(cache_path)
+            mem_cache_put(url, processed_html, content_type, st)
+
+            return cached_response(processed_html, content_type, st)
 
     except Exception as e:
-        return await render_template_string(
-            """
-        <html>
-        <head>
-            <title>Error</title>
-            <style>
-                body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
-                .error { background: #ffeeee; padding: 20px; border-radius: 5px; }
-                a { color: #0066cc; }
-            </style>
-        </head>
-        <body>
-            <h1>Error Fetching URL</h1>
-            <div class="error">
-                <p>There was an error fetching the requested URL: {{ url }}</p>
-                <p>Error: {{ error }}</p>
-            </div>
-            <p><a href="/">Back to home</a></p>
-        </body>
-        </html>
-        """,
-            url=url,
-            error=str(e),
-        )
+        return await ERROR_TEMPLATE.render_async(url=url, error=str(e))
 
 
 if __name__ == "__main__":